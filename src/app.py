@@ -1,22 +1,47 @@
+import os
+
+#OpenMP/MKL read these when torch first loads, so set them before importing it.
+#CPU encoder speedup is near-linear up to ~4-8 threads and flat beyond that.
+NUM_THREADS = min(8, os.cpu_count() or 1)
+os.environ.setdefault('OMP_NUM_THREADS', str(NUM_THREADS))
+os.environ.setdefault('MKL_NUM_THREADS', str(NUM_THREADS))
+
 import streamlit as st
 import json
+import gzip
+import pickle
+import pathlib
+import importlib.util
+import orjson
 import numpy as np
-import torch
-from transformers import AutoTokenizer, AutoModel
-from openai import OpenAI
-import os
-from rag_class import DukeNutritionRAG
+from build_embeddings import EMBEDDINGS_PATH, EMBEDDINGS_F16_PATH, convert_to_f16
 import time
+from collections import deque
+
+#torch, transformers, faiss and openai are imported inside the cached loaders below,
+#so reruns that reuse the cached RAG system never touch them
+
+#Chat messages kept (and rendered) per session
+MAX_MESSAGES = 20
 
-if 'last_call_time' not in st.session_state:
-    st.session_state.last_call_time = 0
+#Token bucket per session: bursts of up to 3 requests, then one every 3 seconds
+BUCKET_CAPACITY = 3
+BUCKET_RATE = 1 / 3  #tokens per second
 
-def rate_limit(seconds=3):
+if 'bucket' not in st.session_state:
+    st.session_state.bucket = (BUCKET_CAPACITY, time.time())
+
+def refill_bucket():
+    """Top up this session's tokens for the time elapsed and return the count."""
+    tokens, last_ts = st.session_state.bucket
     now = time.time()
-    if now - st.session_state.last_call_time < seconds:
-        st.warning("Please wait a moment before making another request.")
-        st.stop()
-    st.session_state.last_call_time = now
+    tokens = min(BUCKET_CAPACITY, tokens + (now - last_ts) * BUCKET_RATE)
+    st.session_state.bucket = (tokens, now)
+    return tokens
+
+def take_token():
+    tokens, last_ts = st.session_state.bucket
+    st.session_state.bucket = (tokens - 1, last_ts)
 
 
 os.environ['TRANSFORMERS_CACHE'] = './model_cache'
@@ -29,77 +54,173 @@ st.set_page_config(
 )
 
 #Custom CSS
-st.markdown("""
-<style>
-    .main-header {
-        font-size: 2.5rem;
-        font-weight: bold;
-        color: #012169;
-        text-align: center;
-        margin-bottom: 1rem;
-    }
-    .sub-header {
-        font-size: 1.2rem;
-        color: #666;
-        text-align: center;
-        margin-bottom: 2rem;
-    }
-    .recommendation-box {
-        background-color: #1e1e1e;
-        border-left: 4px solid #012169;
-        padding: 1.5rem;
-        margin: 1rem 0;
-        border-radius: 8px;
-        color: #e0e0e0;
-        line-height: 1.6;
-    }
-    .user-message {
-        background-color: #012169;
-        color: white;
-        padding: 1rem;
-        border-radius: 8px;
-        margin: 0.5rem 0;
-    }
-    .assistant-message {
-        background-color: #1e1e1e;
-        border-left: 4px solid #012169;
-        color: #e0e0e0;
-        padding: 1rem;
-        border-radius: 8px;
-        margin: 0.5rem 0;
-    }
-    .nutrition-tag {
-        display: inline-block;
-        background-color: #012169;
-        color: white;
-        padding: 0.3rem 0.6rem;
-        border-radius: 12px;
-        margin: 0.2rem;
-        font-size: 0.9rem;
+@st.cache_data
+def load_css():
+    return (pathlib.Path(__file__).parent / 'assets' / 'app.css').read_text()
+
+st.markdown(f"<style>{load_css()}</style>", unsafe_allow_html=True)
+
+MENU_PATH = 'menu_processed.json'
+MENU_PICKLE_PATH = 'menu_processed.pkl.gz'
+
+
+def replace_atomically(path, write):
+    """
+    Call write(tmp_path) on a file beside path, then rename it over path, so
+    readers (or the next start after a crash) never see a half-written file.
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'  #Same directory, so os.replace stays a rename
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def load_menu_data(json_path=MENU_PATH, pickle_path=MENU_PICKLE_PATH):
+    """Load (items, documents), preferring the preparsed pickle over the JSON file."""
+    if os.path.exists(pickle_path) and os.path.getmtime(pickle_path) >= os.path.getmtime(json_path):
+        try:
+            with gzip.open(pickle_path, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass  #Truncated or corrupt cache: reparse the JSON and rewrite it
+    
+    raw = pathlib.Path(json_path).read_bytes()
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        data = json.loads(raw)  #orjson rejects the bare NaN values pandas writes
+    items = data["items"]
+    documents = data["documents"]
+    
+    def write(tmp_path):
+        with gzip.open(tmp_path, 'wb') as f:
+            pickle.dump((items, documents), f, protocol=5)
+    try:
+        replace_atomically(pickle_path, write)
+    except OSError:
+        pass  #e.g. a read-only checkout: keep parsing the JSON each start
+    return items, documents
+
+SOA_NUMERIC_FIELDS = ('calories', 'protein_g', 'total_carbs_g', 'total_fat_g', 'fiber_g', 'sugars_g')
+SOA_TEXT_FIELDS = ('restaurant', 'item_name', 'dietary_labels')
+
+
+def build_items_soa(items):
+    """
+    Struct-of-arrays view of items: one NumPy column per field.
+    
+    Missing numbers are NaN; 'restaurant_id' indexes the returned restaurant names.
+    render_nutrition_details reads these columns instead of each item dict, and
+    filters can run as boolean masks, e.g. (soa['protein_g'] > 30) & (soa['restaurant'] != 'Sazon').
+    """
+    soa = {
+        field: np.array([item.get(field) for item in items], dtype=np.float32)
+        for field in SOA_NUMERIC_FIELDS
     }
-</style>
-""", unsafe_allow_html=True)
+    for field in SOA_TEXT_FIELDS:
+        soa[field] = np.array([item.get(field) for item in items], dtype=object)
+    restaurant_names, soa['restaurant_id'] = np.unique(
+        [item.get('restaurant') or '' for item in items], return_inverse=True
+    )
+    return soa, restaurant_names
+
+INDEX_PATH = 'menu_index.faiss'
+
+
+def load_faiss_index(embeddings, index_path=INDEX_PATH):
+    """
+    Load the persisted FAISS index, or build and save it on first run.
+    
+    Rows of embeddings must already be L2-normalized so inner product equals
+    cosine similarity. Returns None when the catalog is small enough that an
+    exact scan is used instead, or when faiss is not installed.
+    """
+    try:
+        import faiss
+    except ImportError:
+        return None
+    from rag_class import build_faiss_index, configure_faiss_index
+    
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(EMBEDDINGS_F16_PATH):
+        try:
+            index = faiss.read_index(index_path)
+        except RuntimeError:
+            index = None  #Truncated or corrupt file: rebuild and rewrite it
+        if index is not None and index.ntotal == len(embeddings):
+            return configure_faiss_index(index)
+
+    index = build_faiss_index(embeddings)
+    if index is not None:
+        try:
+            replace_atomically(index_path, lambda tmp_path: faiss.write_index(index, tmp_path))
+        except (OSError, RuntimeError):
+            pass  #e.g. a read-only checkout: rebuild each start
+    return index
+
+RAG_INDEX_DIR = 'rag_index'
+
+
+def rag_index_is_fresh(index_dir=RAG_INDEX_DIR):
+    """
+    Whether DukeNutritionRAG.save_index() output is newer than the menu and its
+    embeddings, and was written by the current column-building code.
+    """
+    from rag_class import DukeNutritionRAG
+    
+    marker = os.path.join(index_dir, 'restaurants.json')  #Written last by save_index
+    return os.path.exists(marker) and os.path.getmtime(marker) >= max(
+        os.path.getmtime(MENU_PATH), os.path.getmtime(EMBEDDINGS_F16_PATH)
+    ) and DukeNutritionRAG.saved_index_is_current(index_dir)
+
+EXAMPLE_QUERIES = [
+    "High protein dinner for cutting",
+    "Vegan protein sources at Sprout",
+    "Keto friendly meal",
+    "Post-workout recovery meal",
+    "High fiber breakfast",
+    "High calorie protein meal for bulking"
+]
 
 @st.cache_resource
 def load_rag_system():
     """Load RAG system (cached for performance)"""
+    import torch
+    from transformers import AutoTokenizer, AutoModel
+    import httpx
+    from openai import OpenAI
+    from rag_class import DukeNutritionRAG
+    
+    torch.set_num_threads(NUM_THREADS)
+    try:
+        torch.set_num_interop_threads(2)
+    except RuntimeError:
+        pass  #Only settable once per process, e.g. after the cache is cleared
     
   #  st.write(" Step 1/5: Loading menu data...")
-    with open('menu_processed.json', 'r') as f:
-        data = json.load(f)
-    items = data["items"]
-    documents = data["documents"]
+    items, documents = load_menu_data()
+    items_soa, restaurant_names = build_items_soa(items)
+    unique_restaurants = int(np.count_nonzero(restaurant_names))  #'' (no restaurant) sorts first
   #  st.write(" Menu data loaded!")
     
  #   st.write(" Step 2/5: Loading embeddings...")
-    menu_embeddings = np.load('menu_embeddings.npy')
+    if not os.path.exists(EMBEDDINGS_F16_PATH) or (
+            os.path.exists(EMBEDDINGS_PATH)
+            and os.path.getmtime(EMBEDDINGS_F16_PATH) < os.path.getmtime(EMBEDDINGS_PATH)):
+        convert_to_f16()
+    #Pre-normalized FP16, memory-mapped so only the rows we touch are paged in
+    menu_embeddings = np.load(EMBEDDINGS_F16_PATH, mmap_mode='r')
+    index = load_faiss_index(menu_embeddings)
   #  st.write(" Embeddings loaded!")
     
   #  st.write(" Step 3/5: Downloading embedding model (this takes 2-3 mins)...")
     model_name = "sentence-transformers/all-MiniLM-L6-v2"
-    embedding_tokenizer = AutoTokenizer.from_pretrained(model_name)
-    embedding_model = AutoModel.from_pretrained(model_name)
-  #  st.write(" Embedding model downloaded!")
+    embedding_tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
     
    #st.write(" Step 4/5: Setting up device...")
     if torch.cuda.is_available():
@@ -109,7 +230,29 @@ def load_rag_system():
     else:
         device = "cpu"
     
-    embedding_model = embedding_model.to(device)
+    embedding_model = None
+    if device == "cpu":
+        #int8 ONNX Runtime encoder is several times faster than FP32 PyTorch on CPU
+        try:
+            from export_onnx import load_onnx_int8
+            embedding_model = load_onnx_int8(model_name)
+        except Exception:
+            embedding_model = None  #optimum/onnxruntime missing or export failed
+    if embedding_model is None:
+        #Load weights directly in half precision on GPU (bf16 where supported); embeddings are upcast before pooling
+        if device == "cuda":
+            dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        elif device == "mps":
+            dtype = torch.float16
+        else:
+            dtype = torch.float32
+        embedding_model = AutoModel.from_pretrained(
+            model_name,
+            torch_dtype=dtype,
+            attn_implementation="sdpa"  #Fused scaled_dot_product_attention kernels
+        ).to(device)
+        embedding_model.eval()  #DukeNutritionRAG torch.compiles PyTorch encoders
+  #  st.write(" Embedding model downloaded!")
   #  st.write(f" Using device: {device}")
     
   #  st.write(" Step 5/5: Initializing RAG system...")
@@ -118,30 +261,62 @@ def load_rag_system():
         st.error("OpenAI API key not found!")
         st.stop()
     
-    client = OpenAI(api_key=api_key)
-    
-    rag = DukeNutritionRAG(
-        client=client,
-        embeddings=menu_embeddings,
-        documents=documents,
-        items=items,
-        embedding_model=embedding_model,
-        embedding_tokenizer=embedding_tokenizer,
-        device=device
+    #Keep TLS connections to the API warm between requests; HTTP/2 needs the h2 package
+    http_client = httpx.Client(
+        http2=importlib.util.find_spec("h2") is not None,
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60)
     )
+    client = OpenAI(api_key=api_key, http_client=http_client)
+    
+    rag = None
+    index_fresh = rag_index_is_fresh()
+    if index_fresh:
+        try:
+            #Memory-mapped arrays from a previous start: no per-item preprocessing
+            rag = DukeNutritionRAG.load_index(
+                RAG_INDEX_DIR,
+                client=client,
+                embeddings=menu_embeddings,
+                documents=documents,
+                items=items,
+                embedding_model=embedding_model,
+                embedding_tokenizer=embedding_tokenizer,
+                device=device,
+                index=index
+            )
+        except (OSError, ValueError):
+            rag = None  #Unreadable or mismatched files, build in memory below
+    if rag is None:
+        rag = DukeNutritionRAG(
+            client=client,
+            embeddings=menu_embeddings,
+            documents=documents,
+            items=items,
+            embedding_model=embedding_model,
+            embedding_tokenizer=embedding_tokenizer,
+            device=device,
+            index=index,
+            normalized=True  #convert_to_f16 already normalized the rows
+        )
+        #Only save for new inputs: re-saving after a failed load would fail the same way next start
+        if not index_fresh:
+            rag.save_index(RAG_INDEX_DIR)
+    #Sidebar examples are fixed strings: embed them once, in a single batch
+    rag.precompute_embeddings(EXAMPLE_QUERIES)
     
   #  st.write(" RAG system ready!")
-    return rag, items
+    return rag, items, items_soa, unique_restaurants
 
 #Initialize session state
 if 'messages' not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = deque(maxlen=MAX_MESSAGES)
 if 'last_result' not in st.session_state:
     st.session_state.last_result = None
 
 #Load RAG system
 try:
-    rag, items = load_rag_system()
+    rag, items, items_soa, unique_restaurants = load_rag_system()
 #    st.success(" System loaded successfully")
 except Exception as e:
     st.error(f" Error loading system: {str(e)}")
@@ -160,20 +335,10 @@ with st.sidebar:
     
     st.header("System Stats")
     #st.metric("Total Menu Items", f"{len(items):,}")
-    unique_restaurants = len(set(item['restaurant'] for item in items if item.get('restaurant')))
     st.metric("Dining Locations", unique_restaurants)
     
     st.header("Example Queries")
-    example_queries = [
-        "High protein dinner for cutting",
-        "Vegan protein sources at Sprout",
-        "Keto friendly meal",
-        "Post-workout recovery meal",
-        "High fiber breakfast",
-        "High calorie protein meal for bulking"
-    ]
-    
-    for ex_query in example_queries:
+    for ex_query in EXAMPLE_QUERIES:
         if st.button(ex_query, key=f"ex_{ex_query}"):
             st.session_state['query_input'] = ex_query
     
@@ -195,25 +360,24 @@ with st.sidebar:
         st.info("**Active Filters:**\n" + "\n".join([f"- {f}" for f in active_filters]))
     
     if st.button(" Clear Conversation", use_container_width=True):
-        st.session_state.messages = []
+        st.session_state.messages = deque(maxlen=MAX_MESSAGES)
         st.session_state.last_result = None
-        rag.conversation_history = []
-        rag.dietary_requirement = None
-        rag.excluded_restaurants = []  
-        rag.nutrition_goal = None   
+        rag.reset_conversation()
         st.session_state["query_input"] = ""
         st.rerun()
 
+@st.fragment
+def render_conversation_history(messages):
+    st.markdown("###  Conversation History")
+    for msg in messages:
+        with st.chat_message(msg['role']):
+            st.markdown(msg['content'])
+    st.markdown("---")
+
 #Display conversation history (ONLY PAST MESSAGES, not the current one)
 if len(st.session_state.messages) > 2:  #Only show if there are previous conversations
-    st.markdown("###  Conversation History")
     # Show all messages EXCEPT the last 2 (which are the current query/response)
-    for msg in st.session_state.messages[:-2]:
-        if msg['role'] == 'user':
-            st.markdown(f'<div class="user-message"> You: {msg["content"]}</div>', unsafe_allow_html=True)
-        else:
-            st.markdown(f'<div class="assistant-message"> Assistant: {msg["content"]}</div>', unsafe_allow_html=True)
-    st.markdown("---")
+    render_conversation_history(list(st.session_state.messages)[:-2])
 
 #Main interface
 if "query_input" not in st.session_state:
@@ -232,75 +396,107 @@ query = st.text_area(
 use_conversation_context = st.checkbox("Use conversation context", value=True, 
                                         help="Enable multi-turn conversation with memory")
 
-#Get recommendations button
-if st.button("Get Recommendations", type="primary", use_container_width=True):
-    query = st.session_state.get("query_input", "")
-    if not query.strip():
-        st.warning("Please enter a query!")
-    else:
-        with st.spinner("Finding the best meals for you..."):
-            try:
-                #ALWAYS get exactly 3 recommendations
-                rate_limit(seconds=3)
-                result = rag.ask(
-                    query, 
-                    k=3,  
-                    use_history=use_conversation_context,
-                    verbose=False
-                )
-                
-                #store result in session state
-                st.session_state.last_result = result
-                
-                #Add to conversation history
-                st.session_state.messages.append({"role": "user", "content": query})
-                st.session_state.messages.append({"role": "assistant", "content": result['response']})
-                
-                #clear query box
-                st.session_state['query'] = ''
-                st.rerun()
-                
-            except Exception as e:
-                st.error(f"Error getting recommendations: {str(e)}")
-                st.exception(e)
+def dietary_label_html(labels):
+    """Tag HTML for a dietary labels string, memoized for this session."""
+    cache = st.session_state.setdefault('label_html_cache', {})
+    if labels not in cache:
+        cache[labels] = ''.join([f'<span class="nutrition-tag">{label.strip()}</span>' for label in labels.split(';') if label.strip()])
+    return cache[labels]
 
-#Display last result BELOW the query box
-if st.session_state.last_result:
-    result = st.session_state.last_result
-    
-    st.markdown("---")
-    
-    st.markdown("### Recommendations")
-    st.markdown(f'<div class="recommendation-box">{result["response"]}</div>', unsafe_allow_html=True)
-    
+def nutrition_value(field, idx):
+    """One item's value from a numeric items_soa column, or 'N/A' if missing."""
+    value = items_soa[field][idx]
+    return 'N/A' if np.isnan(value) else value
+
+def render_nutrition_details(retrieved_items):
+    """Show macro metrics and dietary labels for each retrieved item."""
     #Display detailed nutrition for ALL 3 items
     st.markdown("### Detailed Nutrition Information")
     
-    for i, item_result in enumerate(result['retrieved_items'], 1):
-        item = item_result['item']
+    for i, item_result in enumerate(retrieved_items, 1):
+        idx = item_result['index']
         
         #All expanded by default
-        with st.expander(f"**{i}. {item['item_name']}** at {item['restaurant']}", expanded=True):
+        with st.expander(f"**{i}. {items_soa['item_name'][idx]}** at {items_soa['restaurant'][idx]}", expanded=True):
             col_a, col_b, col_c = st.columns(3)
             
             with col_a:
-                st.metric("Calories", f"{item.get('calories', 'N/A')}")
-                st.metric("Protein", f"{item.get('protein_g', 'N/A')}g")
+                st.metric("Calories", f"{nutrition_value('calories', idx)}")
+                st.metric("Protein", f"{nutrition_value('protein_g', idx)}g")
             
             with col_b:
-                st.metric("Carbs", f"{item.get('total_carbs_g', 'N/A')}g")
-                st.metric("Fat", f"{item.get('total_fat_g', 'N/A')}g")
+                st.metric("Carbs", f"{nutrition_value('total_carbs_g', idx)}g")
+                st.metric("Fat", f"{nutrition_value('total_fat_g', idx)}g")
             
             with col_c:
-                st.metric("Fiber", f"{item.get('fiber_g', 'N/A')}g")
-                st.metric("Sugar", f"{item.get('sugars_g', 'N/A')}g")
+                st.metric("Fiber", f"{nutrition_value('fiber_g', idx)}g")
+                st.metric("Sugar", f"{nutrition_value('sugars_g', idx)}g")
             
             # Show dietary labels
-            if item.get('dietary_labels'):
+            labels = items_soa['dietary_labels'][idx]
+            if isinstance(labels, str) and labels:  #NaN when the CSV cell was empty
                 st.markdown("**Dietary Labels:**")
-                labels = str(item['dietary_labels']).split(';')
-                label_html = ''.join([f'<span class="nutrition-tag">{label.strip()}</span>' for label in labels if label.strip()])
-                st.markdown(label_html, unsafe_allow_html=True)
+                st.markdown(dietary_label_html(labels), unsafe_allow_html=True)
+
+#Get recommendations button. A throttled click only shows a toast: no st.stop(), and
+#the button stays enabled because a disabled one would need a rerun to come back
+if st.button("Get Recommendations", type="primary", use_container_width=True):
+    query = st.session_state.get("query_input", "")
+    tokens = refill_bucket()
+    if not query.strip():
+        st.warning("Please enter a query!")
+    elif tokens < 1:
+        st.toast(f"Please wait {(1 - tokens) / BUCKET_RATE:.0f}s before making another request.")
+    else:
+        take_token()
+        try:
+            with st.spinner("Finding the best meals for you..."):
+                #ALWAYS get exactly 3 recommendations
+                retrieved_items = rag.retrieve(query, k=3)
+            
+            #Show the items right away, then stream the answer in above them
+            st.markdown("---")
+            st.markdown("### Recommendations")
+            placeholder = st.empty()
+            render_nutrition_details(retrieved_items)
+            response = placeholder.write_stream(rag.ask_stream(
+                query,
+                k=3,
+                use_history=use_conversation_context,
+                retrieved_items=retrieved_items
+            ))
+            
+            #store result in session state
+            st.session_state.last_result = {
+                'response': response,
+                'retrieved_items': retrieved_items
+            }
+            
+            #Add to conversation history
+            st.session_state.messages.append({"role": "user", "content": query})
+            st.session_state.messages.append({"role": "assistant", "content": response})
+            
+            #clear query box
+            st.session_state['query'] = ''
+            st.rerun()
+            
+        except Exception as e:
+            st.error(f"Error getting recommendations: {str(e)}")
+            st.exception(e)
+
+@st.fragment
+def render_recommendations(result):
+    """Last answer plus its nutrition details, isolated from reruns triggered elsewhere."""
+    st.markdown("---")
+    
+    st.markdown("### Recommendations")
+    st.markdown(f'<div class="recommendation-box">{result["response"]}</div>', unsafe_allow_html=True)
+    
+    render_nutrition_details(result['retrieved_items'])
+
+#Display last result BELOW the query box
+if st.session_state.last_result:
+    render_recommendations(st.session_state.last_result)
 
 # Footer
 st.markdown("---")
@@ -0,0 +1,67 @@
+"""
+Offline build steps for the menu embedding files used by app.py.
+
+    python build_embeddings.py            # menu_embeddings.npy -> menu_embeddings_f16.npy
+    python build_embeddings.py --rebuild  # re-embed menu_processed.json first
+
+app.py also runs the conversion on startup when the FP16 file is missing or
+older than menu_embeddings.npy.
+"""
+import argparse
+import json
+
+import numpy as np
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+MENU_PATH = 'menu_processed.json'
+EMBEDDINGS_PATH = 'menu_embeddings.npy'
+EMBEDDINGS_F16_PATH = 'menu_embeddings_f16.npy'
+
+
+def rebuild_embeddings(menu_path=MENU_PATH, dst=EMBEDDINGS_PATH, model_name=MODEL_NAME):
+    """Re-embed every document in menu_path so rows line up with its items."""
+    #Imported here so app.py can use convert_to_f16 without loading torch
+    import torch
+    from transformers import AutoTokenizer, AutoModel
+    from rag_class import compute_embeddings
+
+    with open(menu_path, 'r') as f:
+        documents = json.load(f)["documents"]
+
+    if torch.cuda.is_available():
+        device = "cuda"
+    elif torch.backends.mps.is_available():
+        device = "mps"
+    else:
+        device = "cpu"
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+    model = AutoModel.from_pretrained(model_name).to(device)
+    model.eval()
+
+    np.save(dst, compute_embeddings(documents, model, tokenizer, device=device))
+    return dst
+
+
+def convert_to_f16(src=EMBEDDINGS_PATH, dst=EMBEDDINGS_F16_PATH):
+    """
+    Save embeddings L2-normalized and in FP16.
+
+    Pre-normalized rows make cosine similarity a plain dot product, and FP16
+    halves the file so it can be memory-mapped cheaply at startup.
+    """
+    embeddings = np.load(src).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    np.save(dst, embeddings.astype(np.float16))
+    return dst
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rebuild', action='store_true',
+                        help=f"re-embed {MENU_PATH} before converting")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        print(f"Saved {rebuild_embeddings()}")
+    print(f"Saved {convert_to_f16()}")
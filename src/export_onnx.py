@@ -0,0 +1,46 @@
+"""
+One-time export of the MiniLM embedding model to an int8 ONNX Runtime model.
+
+Dynamic int8 quantization makes the CPU encoder roughly 2-4x faster and about
+4x smaller than the FP32 PyTorch weights. app.py runs this automatically on
+first start when no export exists, but it can also be run ahead of time:
+
+    python export_onnx.py
+"""
+import os
+
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+ONNX_FP32_DIR = './model_cache/onnx-fp32'
+ONNX_INT8_DIR = './model_cache/onnx-int8'
+ONNX_INT8_FILE = 'model_quantized.onnx'
+
+
+def export_onnx_int8(model_name=MODEL_NAME, fp32_dir=ONNX_FP32_DIR, int8_dir=ONNX_INT8_DIR):
+    """Export model_name to ONNX and dynamically quantize it to int8."""
+    model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+    model.save_pretrained(fp32_dir)
+
+    quantizer = ORTQuantizer.from_pretrained(fp32_dir)
+    quantizer.quantize(
+        save_dir=int8_dir,
+        quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    )
+    return int8_dir
+
+
+def load_onnx_int8(model_name=MODEL_NAME, int8_dir=ONNX_INT8_DIR):
+    """Load the int8 encoder for CPU inference, exporting it first if needed."""
+    if not os.path.exists(os.path.join(int8_dir, ONNX_INT8_FILE)):
+        export_onnx_int8(model_name, int8_dir=int8_dir)
+    return ORTModelForFeatureExtraction.from_pretrained(
+        int8_dir,
+        file_name=ONNX_INT8_FILE,
+        provider='CPUExecutionProvider'
+    )
+
+
+if __name__ == "__main__":
+    print(f"Exporting {MODEL_NAME} to {export_onnx_int8()}")
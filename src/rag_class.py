@@ -1,27 +1,458 @@
+import os
 import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
 import numpy as np
 import torch
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None  #Optional: the ratio-bonus kernel then runs as plain Python
+
+#Past messages sent to the LLM with each query (3 user/assistant turns)
+HISTORY_MESSAGES = 6
+
+#Bump when _build_index() derives its columns differently (_format_item, macro parsing,
+#dietary matching); keyword tables are hashed into the saved index's format key already
+INDEX_FORMAT_VERSION = 1
+#Per-item columns built by _build_index() and written by save_index(), one .npy each
+#(item_templates, a list of strings, goes to item_templates.json instead)
+INDEX_COLUMNS = ('name_ids', 'is_meal', 'restaurant_ids',
+                 'protein', 'carbs', 'fat', 'fiber', 'calories',
+                 'protein_pct', 'carbs_pct', 'fat_pct', '_macros_valid')
+
+# Complete patterns for ALL 27 Duke dining locations
+EXCLUDED_RESTAURANT_PATTERNS = (
+    # Main dining halls
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?marketplace', 'Marketplace'),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?(?:the\s+)?farmstead', 'The Farmstead'),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?trinity', 'Trinity Cafe'),
+    
+    # Quick service
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?il\s*forno', 'Il Forno'),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?sprout', 'Sprout'),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?(?:the\s+)?skillet', 'The Skillet'),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?tandoor', 'Tandoor Indian Cuisine'),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?ginger', 'Ginger + Soy'),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?sazon', 'Sazon'),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?gyotaku', 'Gyotaku'),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?thyme', "It's Thyme"),
+    
+    # Specialty
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?j\.?b\.?\'?s', "J.B.'s Roast & Chops"),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?gothic', 'Gothic Grill'),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?pitchfork', 'The Pitchfork'),
+    
+    # Coffee shops
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?beyu', 'Beyu Blue Coffee'),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?bseisu', 'Bseisu Coffee Bar'),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?freeman', 'Freeman Café'),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?nasher', 'Nasher Museum Café'),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?zweli', "Zweli's Café at Duke Divinity"),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?devils?\s+krafthouse', 'The Devils Krafthouse'),
+    
+    # Delis
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?sanford', 'Sanford Deli'),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?saladalia', 'Saladalia @ The Perk'),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?bella', 'Bella Union'),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?twinnie', "Twinnie's"),
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?red\s+mango', 'Red Mango'),
+    
+    # Special
+    (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?marine\s+lab', 'Duke Marine Lab'),
+)
+
+INCLUDED_RESTAURANT_PATTERNS = (
+    # Main dining halls
+    (r'(?:from|at|only\s+at)\s+marketplace', 'Marketplace'),
+    (r'(?:from|at|only\s+at)\s+(?:the\s+)?farmstead', 'The Farmstead'),
+    (r'(?:from|at|only\s+at)\s+trinity(?:\s+cafe)?', 'Trinity Cafe'),
+    
+    # Quick service & cafes
+    (r'(?:from|at|only\s+at)\s+il\s*forno', 'Il Forno'),
+    (r'(?:from|at|only\s+at)\s+sprout', 'Sprout'),
+    (r'(?:from|at|only\s+at)\s+(?:the\s+)?skillet', 'The Skillet'),
+    (r'(?:from|at|only\s+at)\s+tandoor', 'Tandoor Indian Cuisine'),
+    (r'(?:from|at|only\s+at)\s+ginger(?:\s*\+?\s*soy)?', 'Ginger + Soy'),
+    (r'(?:from|at|only\s+at)\s+sazon', 'Sazon'),
+    (r'(?:from|at|only\s+at)\s+gyotaku', 'Gyotaku'),
+    (r'(?:from|at|only\s+at)\s+(?:it\'?s\s+)?thyme', "It's Thyme"),
+    
+    # Specialty restaurants
+    (r'(?:from|at|only\s+at)\s+j\.?b\.?\'?s', "J.B.'s Roast & Chops"),
+    (r'(?:from|at|only\s+at)\s+gothic\s+grill', 'Gothic Grill'),
+    (r'(?:from|at|only\s+at)\s+(?:the\s+)?pitchfork', 'The Pitchfork'),
+    
+    # Coffee shops
+    (r'(?:from|at|only\s+at)\s+beyu(?:\s+blue)?(?:\s+coffee)?', 'Beyu Blue Coffee'),
+    (r'(?:from|at|only\s+at)\s+bseisu', 'Bseisu Coffee Bar'),
+    (r'(?:from|at|only\s+at)\s+freeman(?:\s+caf[eé])?', 'Freeman Café'),
+    (r'(?:from|at|only\s+at)\s+nasher(?:\s+museum)?(?:\s+caf[eé])?', 'Nasher Museum Café'),
+    (r'(?:from|at|only\s+at)\s+zweli\'?s', "Zweli's Café at Duke Divinity"),
+    (r'(?:from|at|only\s+at)\s+(?:the\s+)?devils?\s+krafthouse', 'The Devils Krafthouse'),
+    
+    # Delis & quick serve
+    (r'(?:from|at|only\s+at)\s+sanford\s+deli', 'Sanford Deli'),
+    (r'(?:from|at|only\s+at)\s+saladalia', 'Saladalia @ The Perk'),
+    (r'(?:from|at|only\s+at)\s+(?:the\s+)?perk', 'Saladalia @ The Perk'),
+    (r'(?:from|at|only\s+at)\s+bella\s+union', 'Bella Union'),
+    (r'(?:from|at|only\s+at)\s+twinnie\'?s', "Twinnie's"),
+    (r'(?:from|at|only\s+at)\s+red\s+mango', 'Red Mango'),
+    
+    # Special locations
+    (r'(?:from|at|only\s+at)\s+duke\s+marine\s+lab', 'Duke Marine Lab'),
+    
+    # Generic (only if no specific match)
+    (r'(?:from|at|only\s+at)\s+(?:the\s+)?cafe(?!\s)', 'Cafe'),  # Match "cafe" but not "cafe something"
+)
+
+#Goal keywords in priority order: the first goal with a keyword anywhere in the query wins
+GOAL_KEYWORDS = (
+    ('post-workout', ('post-workout', 'post workout', 'after workout', 'recovery meal', 'after gym', 'after training')),
+    ('cutting', ('cutting', 'lean', 'weight loss', 'lose weight', 'lose fat', 'cut')),
+    ('bulking', ('bulk', 'gain', 'muscle building', 'mass')),
+    ('keto', ('keto', 'low carb', 'high fat')),
+    ('fiber', ('fiber', 'high fiber', 'digestive', 'gut health')),
+    ('endurance', ('endurance', 'marathon', 'run', 'energy', 'carb', 'cardio')),
+)
+
+DIETARY_KEYWORDS = (
+    ('vegan', ('vegan',)),
+    ('vegetarian', ('vegetarian',)),
+    ('halal', ('halal',)),
+    ('gluten free', ('gluten free', 'gluten-free')),
+)
+DIETARY_REQUIREMENTS = tuple(requirement for requirement, _ in DIETARY_KEYWORDS)
+
+
+def keyword_patterns(table):
+    """(label, keywords) rows -> (pattern, label) rows that match any keyword as a substring."""
+    return tuple(('|'.join(map(re.escape, keywords)), label) for label, keywords in table)
+
+
+def compile_pattern_table(patterns):
+    """
+    Merge a (pattern, label) table into one regex with a named group per row.
+    
+    The alternation sits inside a lookahead, so the single finditer pass tries
+    every position and matches may overlap, as with one re.search per row. Where
+    two rows match at the same position only the earlier row is reported; the
+    restaurant tables never do that, and the detectors only need the first row.
+    """
+    return re.compile('(?=' + '|'.join(f'(?P<g{i}>{pattern})' for i, (pattern, _) in enumerate(patterns)) + ')')
+
+
+def match_pattern_table(regex, patterns, query_lower):
+    """Labels whose pattern occurs in query_lower, in table order."""
+    matched = {int(m.lastgroup[1:]) for m in regex.finditer(query_lower)}
+    return [patterns[i][1] for i in sorted(matched)]
+
+
+#Compiled once at import; each retrieve() scans the query once per table
+EXCLUDED_RESTAURANT_RE = compile_pattern_table(EXCLUDED_RESTAURANT_PATTERNS)
+INCLUDED_RESTAURANT_RE = compile_pattern_table(INCLUDED_RESTAURANT_PATTERNS)
+GOAL_PATTERNS = keyword_patterns(GOAL_KEYWORDS)
+GOAL_RE = compile_pattern_table(GOAL_PATTERNS)
+DIETARY_PATTERNS = keyword_patterns(DIETARY_KEYWORDS)
+DIETARY_RE = compile_pattern_table(DIETARY_PATTERNS)
+
+
+def _item_bonus(protein, protein_pct, carbs_pct, fat_pct, fiber, calories, active):
+    """Ratio bonus for one item; active flags which goal blocks apply, in block order."""
+    # POST-WORKOUT: Prioritize HIGH ABSOLUTE PROTEIN (30-50g) for muscle recovery
+    # also want decent carbs for glycogen replenishment
+    if active[0]:
+        if protein >= 40:  # Excellent protein for recovery
+            return 0.7  # MASSIVE bonus!
+        elif protein >= 30:  # Good protein for recovery
+            return 0.5
+        elif protein >= 20:  # Decent protein
+            return 0.3
+        elif protein < 15:  # Too low for post-workout
+            return -0.3  # PENALTY for low protein!
+    
+    # CUTTING: penalize high-calorie items!
+    if active[1]:
+        if protein_pct >= 40 and calories < 400:
+            return 0.4  # Perfect cutting food: high protein %, low calories
+        elif protein_pct >= 40 and calories < 600:
+            return 0.2  # Good protein but moderate calories
+        elif protein_pct >= 30 and calories < 400:
+            return 0.25
+        elif protein_pct >= 30 and calories < 600:
+            return 0.1
+        elif calories > 600:
+            return -0.2  #PENALTY for high-calorie items when cutting!
+    
+    if active[2]:
+        if 30 <= protein_pct <= 40 and calories >= 300:
+            return 0.25
+        elif protein_pct >= 25:
+            return 0.1
+    
+    if active[3]:
+        if fat_pct >= 60 and carbs_pct < 10:
+            return 0.35
+        elif fat_pct >= 50:
+            return 0.2
+    
+    # FIBER: Use absolute grams and not ratio, Fiber has ~0 calories anyway
+    #MASSIVE bonuses because fiber should dominate the query
+    if active[4]:
+        if fiber >= 8:  # Excellent fiber (8+ grams)
+            return 0.6  # HUGE bonus, will beat most semantic matches
+        elif fiber >= 5:  # Good fiber(5-7 grams)
+            return 0.4
+        elif fiber >= 3:  # Decent fiber(3-4 grams)
+            return 0.2
+    
+    if active[5]:
+        if carbs_pct >= 60:
+            return 0.3
+        elif carbs_pct >= 50:
+            return 0.15
+    
+    return 0.0
+
+
+def _bonus_kernel(protein, protein_pct, carbs_pct, fat_pct, fiber, calories, valid, active):
+    """Ratio bonus per candidate; items without valid macros get 0."""
+    bonuses = np.zeros(protein.shape[0])
+    for i in range(protein.shape[0]):
+        if valid[i]:
+            bonuses[i] = _item_bonus(protein[i], protein_pct[i], carbs_pct[i], fat_pct[i],
+                                     fiber[i], calories[i], active)
+    return bonuses
+
+
+if njit is not None:
+    _item_bonus = njit(cache=True)(_item_bonus)
+    _bonus_kernel = njit(cache=True)(_bonus_kernel)
+
+
+#Below this many items an exact search is already instant, so skip the HNSW graph
+HNSW_MIN_ITEMS = 1000
+#Past this, product-quantize vectors to 32 bytes (vs 1536 for FP32 x 384); IVF256 also needs ~10k points to train
+IVFPQ_MIN_ITEMS = 10_000
+
+
+def configure_faiss_index(index):
+    """Set search-time parameters, which are not all kept by write_index."""
+    if hasattr(index, 'hnsw'):
+        index.hnsw.efSearch = 128  #Must stay above k * multiplier used in retrieve
+    elif hasattr(index, 'nprobe'):
+        index.nprobe = 16
+    return index
+
+
+def build_faiss_index(embeddings, quantize=False):
+    """
+    FAISS inner-product index sized to the catalog, or None for an exact NumPy scan.
+    
+    Rows of embeddings must already be L2-normalized. Small catalogs get no index
+    (HNSW_MIN_ITEMS), mid-sized ones an HNSW graph and large ones IVF-PQ. With
+    quantize=True vectors are stored as 8-bit codes, a quarter of the bytes per
+    scan, using FAISS's SIMD int8 kernels (NumPy has no int8 BLAS, so an int8
+    matmul there is slower than the FP32 one). Also None if faiss is missing.
+    """
+    try:
+        import faiss
+    except ImportError:
+        return None
+    
+    vectors = np.ascontiguousarray(embeddings, dtype=np.float32)  #FAISS only takes FP32
+    dim = vectors.shape[1]
+    if len(vectors) < HNSW_MIN_ITEMS:
+        if not quantize:
+            return None
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    elif len(vectors) < IVFPQ_MIN_ITEMS:
+        if quantize:
+            index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, 32, faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = 200
+    else:
+        index = faiss.index_factory(dim, "IVF256,PQ32", faiss.METRIC_INNER_PRODUCT)
+    index.train(vectors)  #No-op for HNSWFlat; learns code ranges / centroids otherwise
+    index.add(vectors)
+    return configure_faiss_index(index)
+
+
+def compile_encoder(model, tokenizer, device):
+    """torch.compile the encoder and warm it up, or return it unchanged if compiling fails."""
+    if not hasattr(torch, 'compile'):
+        return model
+    #dynamic=True: query lengths vary, and static shapes would recompile for each new length.
+    #Default mode, not 'reduce-overhead': CUDA graphs record a graph and memory pool per input
+    #size, and the cached encoder is shared across Streamlit session threads
+    compiled = torch.compile(model, mode='default', dynamic=True)
+    try:
+        #Compilation is lazy: pay for it here instead of on the user's first query
+        warmup = tokenizer("warm up", return_tensors="pt")
+        with torch.inference_mode():
+            compiled(**{key: value.to(device) for key, value in warmup.items()})
+    except Exception:
+        return model  #No working compiler backend on this host, stay eager
+    return compiled
+
+
+def compute_embeddings(texts, model, tokenizer, batch_size=64, device="cpu"):
+    """
+    Mean-pooled embeddings for texts, one row per text in input order.
+    
+    The whole corpus is tokenized in one call, then SBERT-style smart batching
+    sorts texts by token length so each batch is cut down to its own longest
+    text, and rows are written back to their original positions. Pooling
+    ignores padding tokens, which keeps results identical to embedding each
+    text on its own, as queries are.
+    """
+    #One tokenizer call for the whole corpus (the Rust backend parallelizes it), padded to its longest text
+    encoded = tokenizer(
+        list(texts),
+        return_tensors='pt',
+        padding=True,
+        truncation=True,
+        max_length=512
+    )
+    lengths = encoded['attention_mask'].sum(dim=1).numpy()
+    order = np.argsort(lengths, kind='stable')
+    embeddings = np.empty((len(texts), model.config.hidden_size), dtype=np.float32)
+    
+    with torch.inference_mode():
+        for start in range(0, len(texts), batch_size):
+            batch = order[start:start + batch_size]
+            width = int(lengths[batch].max())
+            #Drop the padding columns no text in this batch needs
+            if tokenizer.padding_side == 'left':
+                inputs = {key: value[batch, -width:] for key, value in encoded.items()}
+            else:
+                inputs = {key: value[batch, :width] for key, value in encoded.items()}
+            inputs = {key: value.to(device) for key, value in inputs.items()}
+            outputs = model(**inputs)
+            
+            mask = inputs['attention_mask'].unsqueeze(-1).float()
+            pooled = (outputs.last_hidden_state.float() * mask).sum(dim=1) / mask.sum(dim=1)
+            embeddings[batch] = pooled.cpu().numpy()
+    
+    return embeddings
+
+
+@dataclass(eq=False)
+class RetrievalResult:
+    """
+    Items returned by retrieve(), best first, as arrays of item indices and scores.
+    
+    Iterating or indexing yields the dicts retrieve() used to return
+    ({'item', 'index', 'score', 'base_similarity', 'ratio_bonus'}), so callers
+    that only need the top k items never allocate them. Slicing returns a
+    RetrievalResult over the sliced arrays.
+    """
+    items: list = field(repr=False)
+    indices: np.ndarray
+    scores: np.ndarray
+    base_similarities: np.ndarray
+    bonuses: np.ndarray
+    
+    def __len__(self):
+        return len(self.indices)
+    
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return RetrievalResult(self.items, self.indices[position], self.scores[position],
+                                   self.base_similarities[position], self.bonuses[position])
+        return {
+            'item': self.items[self.indices[position]],
+            'index': int(self.indices[position]),
+            'score': self.scores[position],
+            'base_similarity': self.base_similarities[position],
+            'ratio_bonus': float(self.bonuses[position])
+        }
+    
+    def __iter__(self):
+        return (self[position] for position in range(len(self)))
+
+
 class DukeNutritionRAG:
     """
     Complete RAG system for Duke nutrition recommendations.
+    
+    embedding_model may be loaded in bf16/fp16 (see app.py); hidden states are
+    upcast to FP32 before pooling. PyTorch encoders are torch.compiled unless
+    compile_model is False; other encoders, e.g. ONNX Runtime models, are used as is.
+    Without an index, one is built from the embeddings for large catalogs (see
+    build_faiss_index; quantize=True stores it as int8). Candidates from an index
+    are re-scored exactly.
+    
+    With normalized=True the embedding rows must already be L2-normalized (e.g.
+    the FP16 memory map from build_embeddings.convert_to_f16) and are used as
+    given: with an index only candidate rows are read, upcast to FP32.
     """
     
+    #Item names containing any of these are not meals
+    exclude_keywords = (
+        'powder', 'powdered', 'sugar', 'syrup', 'honey',
+        'salt', 'pepper', 'sauce', 'dressing', 'spread',
+        'butter', 'oil', 'vinegar', 'seasoning',
+        'whey protein', 'protein powder', 'boost', 'supplement',
+        'condiment', 'topping', 'sprinkles',
+        'mayo', 'vinaigrette', 'shot', 'espresso',
+        'lettuce', 'spinach', 'kale', 'arugula',  #Salad bases, not meals
+        'tomato', 'onion', 'pickle', 'cucumber',  #Toppings, not meals
+        'cheese slice', 'american cheese', 'cheddar cheese'  #Toppings
+    )
+    #One regex search per name instead of a substring test per keyword
+    _exclude_re = re.compile('|'.join(map(re.escape, exclude_keywords)))
+    
     def __init__(self, client, embeddings, documents, items, 
-                 embedding_model, embedding_tokenizer, device):
+                 embedding_model, embedding_tokenizer, device, index=None,
+                 cache_size=1024, columns=None, compile_model=True, quantize=False,
+                 normalized=False):
+        if not getattr(embedding_tokenizer, 'is_fast', False):
+            #The slow Python tokenizers cost more than the MiniLM forward pass itself;
+            #checked first, before the index build and encoder compile spend seconds
+            raise ValueError("embedding_tokenizer must be a fast (Rust) tokenizer; load it with use_fast=True")
         self.client = client
         self.embeddings = embeddings
+        if not normalized:
+            #L2-normalized FP32 copy: cosine similarity becomes an inner product
+            embeddings = np.array(embeddings, dtype=np.float32)
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        if index is None:
+            #ANN search once the catalog is big enough; None keeps the exact scan
+            index = build_faiss_index(embeddings, quantize=quantize)
+        if index is None and embeddings.dtype != np.float32:
+            #The exact scan is one BLAS product over every row, which needs contiguous FP32
+            embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self._emb_norms = embeddings  #Normalized rows; stays an FP16 memory map behind an index
+        self.index = index  #FAISS inner-product index over normalized embeddings, or None
         self.documents = documents
         self.items = items
+        if compile_model and isinstance(embedding_model, torch.nn.Module):
+            embedding_model = compile_encoder(embedding_model, embedding_tokenizer, device)
         self.embedding_model = embedding_model
         self.embedding_tokenizer = embedding_tokenizer
         self.device = device
-        self.conversation_history = []
+        self.conversation_history = deque(maxlen=HISTORY_MESSAGES)
         self.dietary_requirement = None  
         self.excluded_restaurants = []  
         self.included_restaurants = []
         self.nutrition_goal = None    
         
+        #Shared across sessions: repeated queries skip the encoder and the LLM call
+        self.precomputed_embeddings = {}
+        self._embedding_cache = OrderedDict()  #blake2b digest of normalized query -> embedding
+        self._embedding_cache_size = cache_size
+        self._embedding_cache_lock = threading.Lock()
+        self._response_cache = OrderedDict()
+        self._response_cache_size = cache_size
+        self._response_cache_lock = threading.Lock()
+        
+        
         self.system_prompt = """You are a helpful nutrition assistant for Duke University students.
 
 Your job is to recommend ACTUAL MEALS from Duke dining halls based on students' nutrition goals.
@@ -83,196 +514,286 @@ User: "I want a high fiber breakfast"
 Assistant: "For fiber, try the Oatmeal at Marketplace (10g fiber). This is because it's excellent for digestive health..."
 
 Make sure to be flexible with the accepting types of queries."""
+        
+        if columns is None:
+            self._build_index()
+        else:
+            for name, value in columns.items():
+                setattr(self, name, value)
+        #numba compiles (or loads from cache) on first call: pay for it here, not on the first goal query
+        self._ratio_bonuses(np.zeros(1, dtype=np.intp), '', goal='cutting')
     
-    def _compute_embedding(self, text):
-        """Compute embedding for a single text."""
+    def _build_index(self):
+        """
+        Precompute per-item filter and macro columns (struct-of-arrays), so
+        retrieve() filters and scores candidates with NumPy masks instead of
+        re-parsing item dicts on every query.
+        """
+        #Dense int32 id per distinct item name (stable across processes, unlike hash()), for dedup
+        self.name_ids = np.unique(
+            [item['item_name'] for item in self.items], return_inverse=True
+        )[1].astype(np.int32)
+        #A list, not an np.str_ array, which pads every entry to the longest in UCS-4
+        self.item_templates = [self._format_item(item) for item in self.items]
+        self.is_meal = np.array([self._is_actual_meal(item) for item in self.items], dtype=np.bool_)
+        
+        #None (no restaurant) gets an id too, so it is kept by exclusions and dropped by inclusions as before
+        self.restaurant_to_id = {}
+        self.restaurant_ids = np.array(
+            [self.restaurant_to_id.setdefault(item.get('restaurant'), len(self.restaurant_to_id))
+             for item in self.items],
+            dtype=np.int32
+        )
+        
+        self.dietary_flags = {
+            requirement: np.array([self._matches_dietary_requirement(item, requirement) for item in self.items],
+                                  dtype=np.bool_)
+            for requirement in DIETARY_REQUIREMENTS
+        }
+        
+        #Float64 so threshold comparisons match the scalar float() maths exactly; NaN compares False
+        macros = np.zeros((len(self.items), 5), dtype=np.float64)
+        macros_valid = np.ones(len(self.items), dtype=np.bool_)
+        for i, item in enumerate(self.items):
+            try:
+                macros[i] = (
+                    float(item.get('protein_g', 0)),
+                    float(item.get('total_carbs_g', 0)),
+                    float(item.get('total_fat_g', 0)),
+                    float(item.get('fiber_g', 0)),
+                    float(item.get('calories', 1))
+                )
+            except (ValueError, TypeError):
+                macros_valid[i] = False
+        self.protein, self.carbs, self.fat, self.fiber, self.calories = macros.T
+        
+        safe_calories = np.where(self.calories == 0, 1, self.calories)
+        self.protein_pct = np.divide(self.protein * 4, safe_calories) * 100
+        self.carbs_pct = np.divide(self.carbs * 4, safe_calories) * 100
+        self.fat_pct = np.divide(self.fat * 9, safe_calories) * 100
+        #Items that get no ratio bonus at all: unparseable macros or zero calories
+        self._macros_valid = macros_valid & (self.calories != 0)
+    
+    def save_index(self, path):
+        """Write the per-item columns under path for load_index()."""
+        os.makedirs(path, exist_ok=True)
+        for name in INDEX_COLUMNS:
+            np.save(os.path.join(path, f'{name.lstrip("_")}.npy'), getattr(self, name))
+        np.save(os.path.join(path, 'dietary_flags.npy'),
+                np.stack([self.dietary_flags[requirement] for requirement in DIETARY_REQUIREMENTS]))
+        with open(os.path.join(path, 'item_templates.json'), 'w') as f:
+            json.dump(self.item_templates, f)
+        #Dicts keep insertion order, which is id order
+        with open(os.path.join(path, 'restaurants.json'), 'w') as f:
+            json.dump({'format': self.index_format_key(), 'restaurants': list(self.restaurant_to_id)}, f)
+    
+    @classmethod
+    def index_format_key(cls):
+        """Hash of everything besides the items that the saved columns depend on."""
+        return hashlib.sha256(json.dumps(
+            [INDEX_FORMAT_VERSION, INDEX_COLUMNS, cls.exclude_keywords, DIETARY_KEYWORDS]
+        ).encode()).hexdigest()
+    
+    @classmethod
+    def saved_index_is_current(cls, path):
+        """Whether path holds save_index() output written by this version of the code."""
+        try:
+            with open(os.path.join(path, 'restaurants.json')) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return isinstance(saved, dict) and saved.get('format') == cls.index_format_key()
+    
+    @classmethod
+    def load_index(cls, path, client, embeddings, documents, items, embedding_model,
+                   embedding_tokenizer, device, index=None, cache_size=1024, compile_model=True,
+                   quantize=False):
+        """
+        Build the RAG system from a save_index() directory instead of re-deriving
+        its arrays from items.
+        
+        Columns are memory-mapped, so startup skips the per-item scans, and processes
+        loading the same files share one copy in the page cache. embeddings must be
+        L2-normalized rows, e.g. the FP16 memory map of menu_embeddings_f16.npy;
+        they are not saved alongside the columns.
+        """
+        def load(name):
+            return np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+        
+        columns = {name: load(name.lstrip('_')) for name in INDEX_COLUMNS}
+        if len(columns['is_meal']) != len(items):
+            raise ValueError(f"{path} has columns for {len(columns['is_meal'])} items but there are {len(items)}")
+        #Like __init__, allow fewer embedding rows than items (trailing items are never retrieved)
+        if len(embeddings) > len(items):
+            raise ValueError(f"{len(embeddings)} embedding rows but only {len(items)} items")
+        
+        columns['dietary_flags'] = dict(zip(DIETARY_REQUIREMENTS, load('dietary_flags')))
+        if not cls.saved_index_is_current(path):
+            raise ValueError(f"{path} was saved by a different index format")
+        with open(os.path.join(path, 'restaurants.json')) as f:
+            restaurants = json.load(f)['restaurants']
+        columns['restaurant_to_id'] = {name: i for i, name in enumerate(restaurants)}
+        with open(os.path.join(path, 'item_templates.json')) as f:
+            columns['item_templates'] = json.load(f)
+        if len(columns['item_templates']) != len(items):
+            raise ValueError(f"{path} has templates for {len(columns['item_templates'])} items but there are {len(items)}")
+        
+        return cls(client, embeddings, documents, items, embedding_model, embedding_tokenizer,
+                   device, index=index, cache_size=cache_size, columns=columns,
+                   compile_model=compile_model, quantize=quantize, normalized=True)
+    
+    def _compute_embeddings_batch(self, texts):
+        """L2-normalized embeddings for texts, encoded in one padded forward pass."""
         inputs = self.embedding_tokenizer(
-            text, 
+            list(texts), 
             return_tensors="pt", 
             truncation=True, 
             max_length=512, 
             padding=True
-        ).to(self.device)
+        )
+        #Token ids stay int64 even when the model runs in FP16
+        inputs = {key: value.to(self.device) for key, value in inputs.items()}
         
-        with torch.no_grad():
+        with torch.inference_mode():
             outputs = self.embedding_model(**inputs)
-            embedding = outputs.last_hidden_state.mean(dim=1).cpu().numpy()
+            #Masked mean so padded rows match what embedding each text alone gives;
+            #pool in FP32 so half-precision models don't lose cosine accuracy
+            mask = inputs['attention_mask'].unsqueeze(-1).float()
+            pooled = (outputs.last_hidden_state.float() * mask).sum(dim=1) / mask.sum(dim=1)
+            embeddings = pooled.cpu().numpy()
+        
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+    
+    def embed_corpus(self, texts, batch_size=64):
+        """
+        L2-normalized embeddings for many documents, e.g. to rebuild the menu embeddings.
+        
+        Uses compute_embeddings: one tokenizer call for all texts, then
+        length-sorted batches so little compute goes to padding.
+        """
+        embeddings = compute_embeddings(texts, self.embedding_model, self.embedding_tokenizer,
+                                        batch_size=batch_size, device=self.device)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+    
+    def _compute_embedding(self, text):
+        """Compute L2-normalized embedding for a single text."""
+        #A single text is never padded, so this is the plain mean over its tokens
+        return self._compute_embeddings_batch([text])[0]
+    
+    def precompute_embeddings(self, texts):
+        """Embed known queries in one padded batch so embed_query finds them instantly."""
+        for text, embedding in zip(texts, self._compute_embeddings_batch(texts)):
+            self.precomputed_embeddings[text.strip().lower()] = embedding
+    
+    def embed_query(self, query):
+        """Embedding for a query, cached on its normalized text."""
+        #MiniLM's tokenizer is uncased, so case and outer whitespace don't change the embedding
+        key = query.strip().lower()
+        embedding = self._lookup_embedding(key)
+        if embedding is None:
+            embedding = self._store_embedding(key, self._compute_embedding(key))
+        return embedding
+    
+    def embed_queries(self, queries):
+        """Embeddings for several queries as rows; cache misses are encoded in one batch."""
+        keys = [query.strip().lower() for query in queries]
+        embeddings = {}
+        for key in dict.fromkeys(keys):
+            embedding = self._lookup_embedding(key)
+            if embedding is not None:
+                embeddings[key] = embedding
         
-        return embedding.flatten()
+        missing = [key for key in dict.fromkeys(keys) if key not in embeddings]
+        if missing:
+            for key, embedding in zip(missing, self._compute_embeddings_batch(missing)):
+                embeddings[key] = self._store_embedding(key, embedding)
+        return np.stack([embeddings[key] for key in keys])
+    
+    def _embedding_digest(self, key):
+        #Fixed 16-byte digests keep the cache's memory bounded however long queries get
+        return hashlib.blake2b(key.encode(), digest_size=16).digest()
+    
+    def _lookup_embedding(self, key):
+        if key in self.precomputed_embeddings:
+            return self.precomputed_embeddings[key]
+        digest = self._embedding_digest(key)
+        with self._embedding_cache_lock:
+            if digest in self._embedding_cache:
+                self._embedding_cache.move_to_end(digest)
+                return self._embedding_cache[digest]
+        return None
     
-    def _cosine_similarity(self, a, b):
-        """Calculate cosine similarity between two vectors."""
-        return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+    def _store_embedding(self, key, embedding):
+        embedding.setflags(write=False)  #Shared between callers
+        with self._embedding_cache_lock:
+            self._embedding_cache[self._embedding_digest(key)] = embedding
+            if len(self._embedding_cache) > self._embedding_cache_size:
+                self._embedding_cache.popitem(last=False)
+        return embedding
+    
+    def _response_cache_key(self, messages):
+        return hashlib.sha256(json.dumps(messages, sort_keys=True).encode()).hexdigest()
+    
+    def _cached_response(self, key):
+        with self._response_cache_lock:
+            if key in self._response_cache:
+                self._response_cache.move_to_end(key)
+                return self._response_cache[key]
+        return None
+    
+    def _store_response(self, key, answer):
+        with self._response_cache_lock:
+            self._response_cache[key] = answer
+            if len(self._response_cache) > self._response_cache_size:
+                self._response_cache.popitem(last=False)
+    
+    def _stream_chat_completion(self, messages):
+        """Call the LLM and yield the answer as it streams in, reusing it when the exact same messages were sent before."""
+        key = self._response_cache_key(messages)
+        answer = self._cached_response(key)
+        if answer is not None:
+            yield answer
+            return
+        
+        stream = self.client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            temperature=0.7,
+            max_tokens=500,
+            stream=True
+        )
+        parts = []
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                yield parts[-1]
+        #Only a fully received answer is cached
+        self._store_response(key, ''.join(parts))
     
     def _is_actual_meal(self, item):
         """Filter out non-meals (condiments, powders, etc.)."""
         name = item.get('item_name', '').lower()
-        
-        exclude_keywords = [
-            'powder', 'powdered', 'sugar', 'syrup', 'honey',
-            'salt', 'pepper', 'sauce', 'dressing', 'spread',
-            'butter', 'oil', 'vinegar', 'seasoning',
-            'whey protein', 'protein powder', 'boost', 'supplement',
-            'condiment', 'topping', 'sprinkles',
-            'mayo', 'vinaigrette', 'shot', 'espresso',
-            'lettuce', 'spinach', 'kale', 'arugula',  #Salad bases, not meals
-            'tomato', 'onion', 'pickle', 'cucumber',  #Toppings, not meals
-            'cheese slice', 'american cheese', 'cheddar cheese'  #Toppings
-        ]
-        
-        for keyword in exclude_keywords:
-            if keyword in name:
-                return False
-        
-        return True
+        return self._exclude_re.search(name) is None
     
     def _identify_excluded_restaurants(self, query):
         """Identify restaurants to exclude based on query."""
-        query_lower = query.lower()
-        excluded = []
-        
-        # Complete patterns for ALL 27 Duke dining locations
-        restaurant_patterns = [
-            # Main dining halls
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?marketplace', 'Marketplace'),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?(?:the\s+)?farmstead', 'The Farmstead'),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?trinity', 'Trinity Cafe'),
-            
-            # Quick service
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?il\s*forno', 'Il Forno'),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?sprout', 'Sprout'),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?(?:the\s+)?skillet', 'The Skillet'),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?tandoor', 'Tandoor Indian Cuisine'),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?ginger', 'Ginger + Soy'),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?sazon', 'Sazon'),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?gyotaku', 'Gyotaku'),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?thyme', "It's Thyme"),
-            
-            # Specialty
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?j\.?b\.?\'?s', "J.B.'s Roast & Chops"),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?gothic', 'Gothic Grill'),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?pitchfork', 'The Pitchfork'),
-            
-            # Coffee shops
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?beyu', 'Beyu Blue Coffee'),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?bseisu', 'Bseisu Coffee Bar'),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?freeman', 'Freeman Café'),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?nasher', 'Nasher Museum Café'),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?zweli', "Zweli's Café at Duke Divinity"),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?devils?\s+krafthouse', 'The Devils Krafthouse'),
-            
-            # Delis
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?sanford', 'Sanford Deli'),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?saladalia', 'Saladalia @ The Perk'),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?bella', 'Bella Union'),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?twinnie', "Twinnie's"),
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?red\s+mango', 'Red Mango'),
-            
-            # Special
-            (r'(?:no|not|exclude)\s+(?:meals?\s+(?:at|from)\s+)?marine\s+lab', 'Duke Marine Lab'),
-        ]
-        
-        for pattern, restaurant in restaurant_patterns:
-            if re.search(pattern, query_lower):
-                excluded.append(restaurant)
-        
-        return excluded
+        return match_pattern_table(EXCLUDED_RESTAURANT_RE, EXCLUDED_RESTAURANT_PATTERNS, query.lower())
     
     def _identify_included_restaurants(self, query):
         """Identify restaurants to ONLY show based on query."""
-        query_lower = query.lower()
-        included = []
-        
-        # Complete patterns for ALL 27 Duke dining locations
-        restaurant_patterns = [
-            # Main dining halls
-            (r'(?:from|at|only\s+at)\s+marketplace', 'Marketplace'),
-            (r'(?:from|at|only\s+at)\s+(?:the\s+)?farmstead', 'The Farmstead'),
-            (r'(?:from|at|only\s+at)\s+trinity(?:\s+cafe)?', 'Trinity Cafe'),
-            
-            # Quick service & cafes
-            (r'(?:from|at|only\s+at)\s+il\s*forno', 'Il Forno'),
-            (r'(?:from|at|only\s+at)\s+sprout', 'Sprout'),
-            (r'(?:from|at|only\s+at)\s+(?:the\s+)?skillet', 'The Skillet'),
-            (r'(?:from|at|only\s+at)\s+tandoor', 'Tandoor Indian Cuisine'),
-            (r'(?:from|at|only\s+at)\s+ginger(?:\s*\+?\s*soy)?', 'Ginger + Soy'),
-            (r'(?:from|at|only\s+at)\s+sazon', 'Sazon'),
-            (r'(?:from|at|only\s+at)\s+gyotaku', 'Gyotaku'),
-            (r'(?:from|at|only\s+at)\s+(?:it\'?s\s+)?thyme', "It's Thyme"),
-            
-            # Specialty restaurants
-            (r'(?:from|at|only\s+at)\s+j\.?b\.?\'?s', "J.B.'s Roast & Chops"),
-            (r'(?:from|at|only\s+at)\s+gothic\s+grill', 'Gothic Grill'),
-            (r'(?:from|at|only\s+at)\s+(?:the\s+)?pitchfork', 'The Pitchfork'),
-            
-            # Coffee shops
-            (r'(?:from|at|only\s+at)\s+beyu(?:\s+blue)?(?:\s+coffee)?', 'Beyu Blue Coffee'),
-            (r'(?:from|at|only\s+at)\s+bseisu', 'Bseisu Coffee Bar'),
-            (r'(?:from|at|only\s+at)\s+freeman(?:\s+caf[eé])?', 'Freeman Café'),
-            (r'(?:from|at|only\s+at)\s+nasher(?:\s+museum)?(?:\s+caf[eé])?', 'Nasher Museum Café'),
-            (r'(?:from|at|only\s+at)\s+zweli\'?s', "Zweli's Café at Duke Divinity"),
-            (r'(?:from|at|only\s+at)\s+(?:the\s+)?devils?\s+krafthouse', 'The Devils Krafthouse'),
-            
-            # Delis & quick serve
-            (r'(?:from|at|only\s+at)\s+sanford\s+deli', 'Sanford Deli'),
-            (r'(?:from|at|only\s+at)\s+saladalia', 'Saladalia @ The Perk'),
-            (r'(?:from|at|only\s+at)\s+(?:the\s+)?perk', 'Saladalia @ The Perk'),
-            (r'(?:from|at|only\s+at)\s+bella\s+union', 'Bella Union'),
-            (r'(?:from|at|only\s+at)\s+twinnie\'?s', "Twinnie's"),
-            (r'(?:from|at|only\s+at)\s+red\s+mango', 'Red Mango'),
-            
-            # Special locations
-            (r'(?:from|at|only\s+at)\s+duke\s+marine\s+lab', 'Duke Marine Lab'),
-            
-            # Generic (only if no specific match)
-            (r'(?:from|at|only\s+at)\s+(?:the\s+)?cafe(?!\s)', 'Cafe'),  # Match "cafe" but not "cafe something"
-        ]
-        
-        for pattern, restaurant in restaurant_patterns:
-            if re.search(pattern, query_lower):
-                included.append(restaurant)
-        
-        return included
+        return match_pattern_table(INCLUDED_RESTAURANT_RE, INCLUDED_RESTAURANT_PATTERNS, query.lower())
     
     def _detect_nutrition_goal(self, query):
         """Detect nutrition goal from query (for ratio bonuses)."""
-        query_lower = query.lower()
-        
-        #Check for post-workout
-        if any(word in query_lower for word in ['post-workout', 'post workout', 'after workout', 'recovery meal', 'after gym', 'after training']):
-            return 'post-workout'
-        #Check for cutting/weight loss
-        elif any(word in query_lower for word in ['cutting', 'lean', 'weight loss', 'lose weight', 'lose fat', 'cut']):
-            return 'cutting'
-        #Check for bulking/muscle gain
-        elif any(word in query_lower for word in ['bulk', 'gain', 'muscle building', 'mass']):
-            return 'bulking'
-        #Check for keto
-        elif any(word in query_lower for word in ['keto', 'low carb', 'high fat']):
-            return 'keto'
-        #Check for high fiber
-        elif any(word in query_lower for word in ['fiber', 'high fiber', 'digestive', 'gut health']):
-            return 'fiber'
-        #Check for endurance
-        elif any(word in query_lower for word in ['endurance', 'marathon', 'run', 'energy', 'carb', 'cardio']):
-            return 'endurance'
-        
-        return None
+        goals = match_pattern_table(GOAL_RE, GOAL_PATTERNS, query.lower())
+        return goals[0] if goals else None
     
     def _detect_dietary_requirement(self, query):
         """Detect dietary requirements from query."""
-        query_lower = query.lower()
-        
-        if 'vegan' in query_lower:
-            return 'vegan'
-        elif 'vegetarian' in query_lower:
-            return 'vegetarian'
-        elif 'halal' in query_lower:
-            return 'halal'
-        elif 'gluten free' in query_lower or 'gluten-free' in query_lower:
-            return 'gluten free'
-        
-        return None
+        requirements = match_pattern_table(DIETARY_RE, DIETARY_PATTERNS, query.lower())
+        return requirements[0] if requirements else None
     
     def _matches_dietary_requirement(self, item, requirement):
         """Check if item matches dietary requirement."""
@@ -289,97 +810,94 @@ Make sure to be flexible with the accepting types of queries."""
         
         return False
     
-    def _calculate_ratio_score(self, item, query, goal=None):
-        """Calculate bonus score based on macro ratios for query context."""
+    def _ratio_bonuses(self, indices, query, goal=None):
+        """Bonus scores based on macro ratios for query context, one per item index."""
         query_lower = query.lower()
         
         # Use saved goal if not provided
         if not goal and self.nutrition_goal:
             goal = self.nutrition_goal
         
-        try:
-            protein = float(item.get('protein_g', 0))
-            carbs = float(item.get('total_carbs_g', 0))
-            fat = float(item.get('total_fat_g', 0))
-            fiber = float(item.get('fiber_g', 0))
-            calories = float(item.get('calories', 1))
-            
-            if calories == 0:
-                return 0
-            
-            protein_pct = (protein * 4 / calories) * 100
-            carbs_pct = (carbs * 4 / calories) * 100
-            fat_pct = (fat * 9 / calories) * 100
-            
-        except (ValueError, TypeError, ZeroDivisionError):
-            return 0
-        
-        # POST-WORKOUT: Prioritize HIGH ABSOLUTE PROTEIN (30-50g) for muscle recovery
-        # also want decent carbs for glycogen replenishment
-        if goal == 'post-workout' or (not goal and any(word in query_lower for word in ['post-workout', 'post workout', 'after workout', 'recovery'])):
-            if protein >= 40:  # Excellent protein for recovery
-                return 0.7  # MASSIVE bonus!
-            elif protein >= 30:  # Good protein for recovery
-                return 0.5
-            elif protein >= 20:  # Decent protein
-                return 0.3
-            elif protein < 15:  # Too low for post-workout
-                return -0.3  # PENALTY for low protein!
-        
-        # Ue goal if provided, otherwise check query
-        if goal == 'cutting' or (not goal and any(word in query_lower for word in ['cutting', 'lean', 'weight loss', 'lose weight', 'lose fat'])):
-            # For cutting: penalize high-calorie items!
-            if protein_pct >= 40 and calories < 400:
-                return 0.4  # Perfect cutting food: high protein %, low calories
-            elif protein_pct >= 40 and calories < 600:
-                return 0.2  # Good protein but moderate calories
-            elif protein_pct >= 30 and calories < 400:
-                return 0.25
-            elif protein_pct >= 30 and calories < 600:
-                return 0.1
-            elif calories > 600:
-                return -0.2  #PENALTY for high-calorie items when cutting!
-        
-        if goal == 'bulking' or (not goal and any(word in query_lower for word in ['bulk', 'gain', 'muscle building'])):
-            if 30 <= protein_pct <= 40 and calories >= 300:
-                return 0.25
-            elif protein_pct >= 25:
-                return 0.1
-        
-        if goal == 'keto' or (not goal and any(word in query_lower for word in ['keto', 'low carb', 'high fat'])):
-            if fat_pct >= 60 and carbs_pct < 10:
-                return 0.35
-            elif fat_pct >= 50:
-                return 0.2
-        
-        # FIBER: Use absolute grams and not ratio, Fiber has ~0 calories anyway
-        #MASSIVE bonuses because fiber should dominate the query
-        if goal == 'fiber' or (not goal and any(word in query_lower for word in ['fiber', 'high fiber', 'digestive'])):
-            if fiber >= 8:  # Excellent fiber (8+ grams)
-                return 0.6  # HUGE bonus, will beat most semantic matches
-            elif fiber >= 5:  # Good fiber(5-7 grams)
-                return 0.4
-            elif fiber >= 3:  # Decent fiber(3-4 grams)
-                return 0.2
-        
-        if goal == 'endurance' or (not goal and any(word in query_lower for word in ['endurance', 'marathon', 'run', 'energy', 'carb'])):
-            if carbs_pct >= 60:
-                return 0.3
-            elif carbs_pct >= 50:
-                return 0.15
-        
-        return 0
+        #Goal blocks that apply, in the order _item_bonus checks them;
+        #a block with no matching rule falls through to the next one
+        active = np.array([
+            goal == 'post-workout' or (not goal and any(word in query_lower for word in ['post-workout', 'post workout', 'after workout', 'recovery'])),
+            # Ue goal if provided, otherwise check query
+            goal == 'cutting' or (not goal and any(word in query_lower for word in ['cutting', 'lean', 'weight loss', 'lose weight', 'lose fat'])),
+            goal == 'bulking' or (not goal and any(word in query_lower for word in ['bulk', 'gain', 'muscle building'])),
+            goal == 'keto' or (not goal and any(word in query_lower for word in ['keto', 'low carb', 'high fat'])),
+            goal == 'fiber' or (not goal and any(word in query_lower for word in ['fiber', 'high fiber', 'digestive'])),
+            goal == 'endurance' or (not goal and any(word in query_lower for word in ['endurance', 'marathon', 'run', 'energy', 'carb'])),
+        ], dtype=np.bool_)
+        
+        if not active.any():
+            return np.zeros(len(indices))
+        
+        return _bonus_kernel(
+            self.protein[indices],
+            self.protein_pct[indices],
+            self.carbs_pct[indices],
+            self.fat_pct[indices],
+            self.fiber[indices],
+            self.calories[indices],
+            self._macros_valid[indices],
+            active
+        )
     
     def reset_conversation(self):
         """Reset conversation-specific memory."""
-        self.conversation_history = []
+        self.conversation_history = deque(maxlen=HISTORY_MESSAGES)
         self.dietary_requirement = None
         self.excluded_restaurants = []
         self.included_restaurants = []
         self.nutrition_goal = None
 
+    def _candidate_pool(self, query_vecs, top_n):
+        """
+        Per query row, up to top_n (indices, similarities) in search order.
+        
+        The hits for a smaller top_n are a prefix of those for a larger one (for
+        HNSW while top_n stays under efSearch), so one pool built for the widest
+        window serves every query's window.
+        """
+        if self.index is not None:
+            _, hits = self.index.search(query_vecs, top_n)
+            pool = []
+            for query_vec, indices in zip(query_vecs, hits):
+                indices = indices[indices >= 0]  #FAISS pads with -1 when fewer than top_n hits
+                #Re-score candidates exactly: quantized indexes (IVF-PQ) only return approximate scores
+                pool.append((indices, self._emb_norms[indices].astype(np.float32, copy=False) @ query_vec))
+            return pool
+        
+        #One GEMM for all queries (a matrix-vector product for one)
+        similarities = query_vecs @ self._emb_norms.T
+        top_n = min(top_n, similarities.shape[1])
+        #Partial selection of the top_n, then sort only those
+        indices = np.sort(np.argpartition(-similarities, top_n - 1, axis=1)[:, :top_n], axis=1)
+        scores = np.take_along_axis(similarities, indices, axis=1)
+        order = np.argsort(-scores, axis=1, kind='stable')
+        return list(zip(np.take_along_axis(indices, order, axis=1), np.take_along_axis(scores, order, axis=1)))
+    
     def retrieve(self, query, k=5):
         """Retrieve top k relevant items with filtering and bonuses."""
+        return self._retrieve(query, k)
+    
+    def retrieve_many(self, queries, k=5):
+        """
+        retrieve() for each query in turn, with one encoder pass and one similarity
+        search for all of them.
+        
+        Queries still update the conversation state in order, so results match
+        calling retrieve() in a loop.
+        """
+        if not queries:
+            return []  #np.stack in embed_queries rejects an empty list
+        query_vecs = self.embed_queries(queries).astype(np.float32)
+        #Largest candidate window retrieve() uses (multiplier 10)
+        pools = self._candidate_pool(query_vecs, k*10)
+        return [self._retrieve(query, k, pool) for query, pool in zip(queries, pools)]
+    
+    def _retrieve(self, query, k, pool=None):
         #Detect and save dietary requirement
         dietary_req = self._detect_dietary_requirement(query)
         if dietary_req:
@@ -410,43 +928,27 @@ Make sure to be flexible with the accepting types of queries."""
         else:
             multiplier = 4
         
-        #Compute query embedding
-        query_embedding = self._compute_embedding(query)
-        
-        #Calculate similarities
-        raw_results = []
-        for i, doc_embedding in enumerate(self.embeddings):
-            similarity = self._cosine_similarity(query_embedding, doc_embedding)
-            raw_results.append({
-                'item': self.items[i],
-                'score': similarity,
-                'base_similarity': similarity,
-                'ratio_bonus': 0
-            })
+        #Calculate similarities (query embedding is normalized, so dot product = cosine)
+        top_n = k*multiplier
+        if pool is None:
+            query_vec = self.embed_query(query).astype(np.float32)
+            pool = self._candidate_pool(query_vec.reshape(1, -1), top_n)[0]
+        indices, scores = pool[0][:top_n], pool[1][:top_n]
         
         #Sort by similarity
-        raw_results.sort(key=lambda x: x['score'], reverse=True)
-        raw_results = raw_results[:k*multiplier]
+        order = np.argsort(-scores, kind='stable')
+        candidates = indices[order]
+        similarities = scores[order]
         
-        #Filter non-meals + dietary
-        filtered_meals = []
-        for result in raw_results:
-            item = result['item']
-            
-            #Hard dietary filter
-            if dietary_req:
-                if not self._matches_dietary_requirement(item, dietary_req):
-                    continue
-            
-            if self._is_actual_meal(item):
-                filtered_meals.append(result)
+        #Filter non-meals + dietary (hard filter)
+        keep = self.is_meal[candidates]
+        if dietary_req:
+            keep &= self.dietary_flags[dietary_req][candidates]
         
         #Filter excluded restaurants (use saved list!)
         if self.excluded_restaurants:
-            filtered_meals = [
-                r for r in filtered_meals 
-                if r['item'].get('restaurant') not in self.excluded_restaurants
-            ]
+            excluded_ids = [self.restaurant_to_id[r] for r in self.excluded_restaurants if r in self.restaurant_to_id]
+            keep &= ~np.isin(self.restaurant_ids[candidates], excluded_ids)
         included_now = self._identify_included_restaurants(query)
 
         if included_now:
@@ -457,76 +959,76 @@ Make sure to be flexible with the accepting types of queries."""
 
         # Apply included filter (overrides excluded if both present)
         if self.included_restaurants:
-            filtered_meals = [
-                r for r in filtered_meals
-                if r["item"].get("restaurant") in self.included_restaurants
-            ]
-        
-        #Apply ratio bonuses(using saved goal!)
-        for result in filtered_meals:
-            bonus = self._calculate_ratio_score(result['item'], query, goal=self.nutrition_goal)
-            result['ratio_bonus'] = bonus
-            result['score'] = result['base_similarity'] + bonus
-        
-        #Re-sort by total score
-        filtered_meals.sort(key=lambda x: x['score'], reverse=True)
-        
-        #Deduplication
-        seen_names = set()
-        unique_results = []
-        
-        for result in filtered_meals:
-            name = result['item']['item_name']
-            if name not in seen_names:
-                seen_names.add(name)
-                unique_results.append(result)
-                if len(unique_results) >= k:
-                    break
+            included_ids = [self.restaurant_to_id[r] for r in self.included_restaurants if r in self.restaurant_to_id]
+            keep &= np.isin(self.restaurant_ids[candidates], included_ids)
+        
+        #Apply ratio bonuses(using saved goal!), re-sort by total score and deduplicate,
+        #all as arrays over the filtered candidates
+        filtered = candidates[keep]
+        base_similarities = similarities[keep]
+        bonuses = self._ratio_bonuses(filtered, query, goal=self.nutrition_goal)
+        totals = base_similarities + bonuses.astype(np.float32)
+        order = np.argsort(-totals, kind='stable')
+        
+        #Each name's first position in score order is its best candidate; positions are
+        #unique, so partial selection of the k smallest picks the top k names
+        ranks = np.unique(self.name_ids[filtered[order]], return_index=True)[1]
+        if len(ranks) > k:
+            ranks = np.partition(ranks, k - 1)[:k]
+        top = order[np.sort(ranks)]
         
         #ERROR HANDLING:If no results found, try again with relaxed filters
-        if len(unique_results) == 0:
-            #Fall back to just similarity without dietary/restaurant filters
-            for result in raw_results[:k*2]:
-                if self._is_actual_meal(result['item']):
-                    unique_results.append(result)
-                    if len(unique_results) >= k:
-                        break
+        if len(top) == 0:
+            #Fall back to just similarity without dietary/restaurant filters: the meal mask
+            #alone over the top k*2 similarity window
+            fallback = np.flatnonzero(self.is_meal[candidates[:k*2]])[:k]
+            return RetrievalResult(
+                items=self.items,
+                indices=candidates[fallback],
+                scores=similarities[fallback],
+                base_similarities=similarities[fallback],
+                bonuses=np.zeros(len(fallback))
+            )
+        
+        return RetrievalResult(
+            items=self.items,
+            indices=filtered[top],
+            scores=totals[top],
+            base_similarities=base_similarities[top],
+            bonuses=bonuses[top]
+        )
+    
+    def _format_item(self, item):
+        """One item's context entry, without its rank prefix."""
+        name = item['item_name']
+        restaurant = item.get('restaurant', 'Unknown')
+        calories = item.get('calories', 'N/A')
+        protein = item.get('protein_g', 'N/A')
+        carbs = item.get('total_carbs_g', 'N/A')
+        fat = item.get('total_fat_g', 'N/A')
+        fiber = item.get('fiber_g', 'N/A')
         
-        return unique_results
+        return (
+            f"{name} at {restaurant}\n"
+            f"   - Calories: {calories}\n"
+            f"   - Protein: {protein}g, Carbs: {carbs}g, Fat: {fat}g, Fiber: {fiber}g"
+        )
     
     def format_context(self, retrieved_items):
         """Format retrieved items as context for LLM."""
-        context_parts = []
-        
-        for i, result in enumerate(retrieved_items, 1):
-            item = result['item']
-            name = item['item_name']
-            restaurant = item.get('restaurant', 'Unknown')
-            calories = item.get('calories', 'N/A')
-            protein = item.get('protein_g', 'N/A')
-            carbs = item.get('total_carbs_g', 'N/A')
-            fat = item.get('total_fat_g', 'N/A')
-            fiber = item.get('fiber_g', 'N/A')
-            
-            context_parts.append(
-                f"{i}. {name} at {restaurant}\n"
-                f"   - Calories: {calories}\n"
-                f"   - Protein: {protein}g, Carbs: {carbs}g, Fat: {fat}g, Fiber: {fiber}g"
-            )
+        if isinstance(retrieved_items, RetrievalResult):
+            indices = retrieved_items.indices
+        else:
+            indices = [result['index'] for result in retrieved_items]
         
-        return "\n\n".join(context_parts)
+        #Entries are formatted once in _build_index(); only the rank changes per query
+        return "\n\n".join(
+            f"{i}. {self.item_templates[index]}"
+            for i, index in enumerate(indices, 1)
+        )
     
-    def ask(self, query, k=5, use_history=False, verbose=False):
-        """Main method to get recommendations."""
-        #Retrieve relevant items
-        retrieved_items = self.retrieve(query, k=k)
-        
-        if verbose:
-            print(f"\n🔍 Retrieved {len(retrieved_items)} items:")
-            for result in retrieved_items:
-                item = result['item']
-                print(f"   - {item['item_name']} (score: {result['score']:.3f})")
-        
+    def _build_messages(self, query, retrieved_items, use_history):
+        """Build the chat messages for a query and its retrieved items."""
         #Format context
         context = self.format_context(retrieved_items)
         
@@ -534,29 +1036,54 @@ Make sure to be flexible with the accepting types of queries."""
         messages = [{"role": "system", "content": self.system_prompt}]
         
         if use_history:
-            messages.extend(self.conversation_history)
+            messages.extend(self.conversation_history)  #deque keeps only the last HISTORY_MESSAGES
         
         messages.append({
             "role": "user",
             "content": f"Based on these Duke dining hall items:\n\n{context}\n\nUser query: {query}"
         })
+        return messages
+    
+    def _remember_turn(self, query, answer):
+        self.conversation_history.append({"role": "user", "content": query})
+        self.conversation_history.append({"role": "assistant", "content": answer})
+    
+    def ask(self, query, k=5, use_history=False, verbose=False):
+        """Main method to get recommendations."""
+        #Retrieve relevant items
+        retrieved_items = self.retrieve(query, k=k)
         
-        #Get LLM response
-        response = self.client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=500
-        )
-        
-        answer = response.choices[0].message.content
+        if verbose:
+            print(f"\n🔍 Retrieved {len(retrieved_items)} items:")
+            for result in retrieved_items:
+                item = result['item']
+                print(f"   - {item['item_name']} (score: {result['score']:.3f})")
         
-        #Update history if needed
-        if use_history:
-            self.conversation_history.append({"role": "user", "content": query})
-            self.conversation_history.append({"role": "assistant", "content": answer})
+        #Same streamed call as the UI, just consumed in full (this also updates history)
+        answer = ''.join(self.ask_stream(query, k=k, use_history=use_history, retrieved_items=retrieved_items))
         
         return {
             'response': answer,
             'retrieved_items': retrieved_items
-        }
\ No newline at end of file
+        }
+    
+    def ask_stream(self, query, k=5, use_history=False, retrieved_items=None):
+        """
+        Generator version of ask() that yields the response text as it streams in.
+        
+        Pass retrieved_items from an earlier retrieve() call to show them before
+        the answer starts; otherwise retrieval runs here. History is only updated
+        once the stream has been fully consumed.
+        """
+        if retrieved_items is None:
+            retrieved_items = self.retrieve(query, k=k)
+        
+        messages = self._build_messages(query, retrieved_items, use_history)
+        
+        parts = []
+        for part in self._stream_chat_completion(messages):
+            parts.append(part)
+            yield part
+        
+        if use_history:
+            self._remember_turn(query, ''.join(parts))